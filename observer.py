@@ -1,18 +1,61 @@
 import argparse
 import collections
+import functools
+import json
 import os
 import sys
 import time
-import pathlib
 import re
+import shutil
+import stat
+import threading
 import requests
 import logging
 
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import (
+    DirCreatedEvent,
+    FileClosedEvent,
+    FileCreatedEvent,
+    FileModifiedEvent,
+    FileMovedEvent,
+    FileSystemEventHandler,
+)
+
+try:
+    from lxml import html
+except ImportError:
+    html = None
 
 log = logging.getLogger()
 
+# ".*<literal>$" and ".*<literal>(.*)" patterns reduce to plain string tests
+_DECOMPOSABLE = re.compile(r"\.\*((?:\\\W|[^.^$*+?{}\[\]|()\\])+)(\$|\.\*)?")
+
+
+def split_excluded(excluded):
+    """
+    Splits excluded regexes into suffixes, substrings and a regex for the rest.
+
+    Patterns which are just anchored suffix or substring tests are checked with
+    str methods, anything else falls back to a single compiled alternation.
+    """
+    suffixes, substrings, rest = [], [], []
+    for pattern in excluded:
+        decomposed = _DECOMPOSABLE.fullmatch(pattern)
+        if not decomposed:
+            rest.append(pattern)
+            continue
+        literal = re.sub(r"\\(\W)", r"\1", decomposed.group(1))
+        if decomposed.group(2) == "$":
+            suffixes.append(literal)
+        else:
+            substrings.append(literal)
+    rest_re = re.compile("|".join(f"(?:{p})" for p in rest)) if rest else None
+    return tuple(suffixes), tuple(substrings), rest_re
+
 
 class NewFileHander(FileSystemEventHandler):
     def __init__(
@@ -24,11 +67,20 @@ class NewFileHander(FileSystemEventHandler):
         recursive=False,
         delay=0,
         ln_duration=0,
+        workers=4,
+        settle=0,
         **kwargs,
     ):
         """
         Handler for observing file modifications.
 
+        Files are processed once they are closed after writing or moved into the
+        observed folder. Observers which don't report closed files (anything but
+        inotify) dispatch modifications instead, and polling observer also creations.
+        With settle set (in seconds), created and modified files are held until
+        their size and modification time don't change for that long, then they
+        are processed as finished.
+
         extension_mapper should be an object providing .get function, such as dict,
         default dict or special function, and it should return subfolder name for given
         destination folder. Also, destination folder can be specified as root folder
@@ -39,85 +91,449 @@ class NewFileHander(FileSystemEventHandler):
 
         exluded param should consist of regexes for excluded files
 
+        If extension mapper also provides .extension and .lookup functions (as
+        ExtensionMapper does), files with unknown extensions are resolved by
+        a pool of workers, so slow lookups don't block event dispatch.
+
         """
         super().__init__(*args, **kwargs)
         self.extension_mapper = extension_mapper
         self.destination_folder = destination_folder
-        self.excluded = excluded
+        self._endswith, self._contains, self._excluded_re = split_excluded(excluded)
         self.recursive = recursive
         self.delay = delay
         self.ln_duration = ln_duration
+        self._known_dirs = set()
+        self._dest_cache = {}
+        self._dev_cache = {}
+        self._async_lookup = hasattr(extension_mapper, "lookup")
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self.settle = settle
+        self._unsettled = {}
+        self._unsettled_lock = threading.Lock()
+        self._stopped = threading.Event()
+        if settle:
+            threading.Thread(target=self._settle_loop, daemon=True).start()
+
+    def _is_excluded(self, origin):
+        return (
+            origin.endswith(self._endswith)
+            or any(s in origin for s in self._contains)
+            or (self._excluded_re and self._excluded_re.match(origin))
+        )
+
+    def on_closed(self, event):
+        self._handle(event.src_path, finished=True)
+
+    def on_moved(self, event):
+        # moves out of observed folder have no destination, files are moved
+        # (or renamed from temporary names) into it once they are written
+        if event.dest_path:
+            self._handle(event.dest_path, finished=True)
 
     def on_modified(self, event):
-        if not os.path.isfile(event.src_path):
+        self._changed(event.src_path)
+
+    def on_created(self, event):
+        self._changed(event.src_path)
+
+    def _changed(self, src_path):
+        if not self.settle:
+            self._handle(src_path)
             return
 
-        origin = event.src_path.split(os.path.sep)[-1]
+        # file might still be copied, wait until it stops changing
+        with self._unsettled_lock:
+            self._unsettled[src_path] = None
+
+    def _settle_loop(self):
+        while not self._stopped.wait(self.settle):
+            settled = []
+            with self._unsettled_lock:
+                for src_path, last in list(self._unsettled.items()):
+                    try:
+                        st = os.lstat(src_path)
+                    except OSError:
+                        del self._unsettled[src_path]
+                        continue
+
+                    current = (st.st_size, st.st_mtime_ns)
+                    if current == last:
+                        del self._unsettled[src_path]
+                        settled.append(src_path)
+                    else:
+                        self._unsettled[src_path] = current
+
+            for src_path in settled:
+                self._handle(src_path, finished=True)
+
+    def _handle(self, src_path, finished=False):
+        """
+        Processes file at src_path. Unless finished is set, file might still be
+        written to, so it's only renamed, never copied across devices.
+        """
+        # lstat, so links left by ln_duration are never taken for files
+        try:
+            st = os.lstat(src_path)
+        except OSError:
+            return
 
-        if any((re.match(pattern, origin) for pattern in self.excluded)):
+        if not stat.S_ISREG(st.st_mode):
+            return
+
+        origin = os.path.basename(src_path)
+
+        if self._is_excluded(origin):
             return
 
         if self.delay:
             time.sleep(self.delay)
 
-        log.debug(f"processing {origin}")
+        log.debug("processing %s", origin)
 
-        destination_folder = os.path.join(
-            self.destination_folder, self.extension_mapper.get(origin)
-        )
+        if not self._async_lookup:
+            category = self.extension_mapper.get(origin)
+            self._move(src_path, origin, st.st_dev, category, finished)
+            return
+
+        extension = self.extension_mapper.extension(origin)
+        category = self.extension_mapper.lookup(extension)
+        if category is not None:
+            self._move(src_path, origin, st.st_dev, category, finished)
+            return
+
+        with self._pending_lock:
+            waiting = self._pending.get(extension)
+            if waiting is not None:
+                waiting.append((src_path, origin, st.st_dev, finished))
+                return
+            self._pending[extension] = [(src_path, origin, st.st_dev, finished)]
 
-        log.debug(f"Destination folder: {destination_folder}")
+        log.debug("resolving extension %s in background", extension)
+        future = self._executor.submit(self.extension_mapper.get, origin)
+        future.add_done_callback(functools.partial(self._resolved, extension))
 
-        pathlib.Path(destination_folder).mkdir(parents=True, exist_ok=True)
+    def _resolved(self, extension, future):
+        with self._pending_lock:
+            waiting = self._pending.pop(extension)
 
         try:
-            os.rename(
-                event.src_path, os.path.join(destination_folder, origin),
-            )
+            category = future.result()
+        except Exception as e:
+            log.error("resolving extension %s failed due to error: %s", extension, e)
+            return
+
+        for src_path, origin, st_dev, finished in waiting:
+            self._move(src_path, origin, st_dev, category, finished)
+
+    def _destination(self, category):
+        destination_folder = self._dest_cache.get(category)
+        if destination_folder is None:
+            destination_folder = os.path.join(self.destination_folder, category)
+            self._dest_cache[category] = destination_folder
+
+        log.debug("Destination folder: %s", destination_folder)
+
+        if destination_folder not in self._known_dirs:
+            os.makedirs(destination_folder, exist_ok=True)
+            self._known_dirs.add(destination_folder)
+
+        return destination_folder
+
+    def _forget(self, folder):
+        """
+        Drops folder from caches, if it was removed after being created.
+        """
+        if os.path.isdir(folder):
+            return False
+
+        self._known_dirs.discard(folder)
+        self._dev_cache.pop(folder, None)
+        return True
+
+    def _device(self, folder):
+        try:
+            return self._dev_cache[folder]
+        except KeyError:
+            st_dev = self._dev_cache[folder] = os.stat(folder).st_dev
+            return st_dev
+
+    def _move(self, src_path, origin, st_dev, category, finished):
+        destination_folder = self._destination(category)
+        destination = os.path.join(destination_folder, origin)
+
+        try:
+            if st_dev == self._device(destination_folder):
+                os.rename(src_path, destination)
+            elif finished:
+                shutil.move(src_path, destination)
+            else:
+                # copying a file which is still written to would truncate it
+                log.warning("not copying %s across devices before it's written", origin)
+                return
         except Exception as e:
-            log.error(f"processing {origin} failed due to error:", e)
+            if isinstance(e, FileNotFoundError) and self._forget(destination_folder):
+                return self._move(src_path, origin, st_dev, category, finished)
+            log.error("processing %s failed due to error: %s", origin, e)
             return
 
         if self.ln_duration:
-            log.debug(f"creating symlink for {origin}")
-            os.symlink(
-                os.path.join(destination_folder, origin), event.src_path,
-            )
+            log.debug("creating symlink for %s", origin)
+            os.symlink(destination, src_path)
+            time.sleep(self.ln_duration)
+            log.debug("removing symlink for %s", origin)
+            os.remove(src_path)
+
+    def sort(self, paths):
+        """
+        Sorts already existing regular files in one batch.
+
+        Files are grouped by extension, so every extension is resolved once, and
+        then by destination folder, so every folder is created and opened once and
+        files are renamed relative to its descriptor. Delay is not applied to old
+        files and temporary links, if requested, are kept for ln_duration once for
+        the whole batch. Files of extensions which failed to resolve are left.
+        """
+        # without .extension every file name is its own group
+        extension = self.extension_mapper.extension if self._async_lookup else str
+
+        by_extension = collections.defaultdict(list)
+        for src_path in paths:
+            origin = os.path.basename(src_path)
+            if not self._is_excluded(origin):
+                by_extension[extension(origin)].append((src_path, origin))
+
+        # every extension is resolved once, unknown ones concurrently
+        futures = {
+            key: self._executor.submit(self.extension_mapper.get, files[0][1])
+            for key, files in by_extension.items()
+        }
+        groups = collections.defaultdict(list)
+        for key, future in futures.items():
+            try:
+                category = future.result()
+            except Exception as e:
+                log.error("resolving extension %s failed due to error: %s", key, e)
+                continue
+            groups[category].extend(by_extension[key])
+
+        moved = []
+        for category, files in groups.items():
+            moved.extend(self._move_batch(category, files))
+
+        if self.ln_duration and moved:
+            log.debug("creating symlinks for %d files", len(moved))
+            for src_path, destination in moved:
+                os.symlink(destination, src_path)
             time.sleep(self.ln_duration)
-            log.debug(f"removing symlink for {origin}")
-            os.remove(event.src_path)
+            log.debug("removing symlinks for %d files", len(moved))
+            for src_path, _ in moved:
+                os.remove(src_path)
+
+    def _move_batch(self, category, files):
+        destination_folder = self._destination(category)
+        dir_fd = None
+        if os.rename in os.supports_dir_fd:
+            dir_fd = os.open(destination_folder, os.O_RDONLY | os.O_DIRECTORY)
+
+        st_dev = self._device(destination_folder)
+
+        moved = []
+        try:
+            for src_path, origin in files:
+                log.debug("processing %s", origin)
+                destination = os.path.join(destination_folder, origin)
+                try:
+                    # regular files live on the same device as their folder
+                    if self._device(os.path.dirname(src_path) or ".") != st_dev:
+                        shutil.move(src_path, destination)
+                    elif dir_fd is None:
+                        os.rename(src_path, destination)
+                    else:
+                        os.rename(src_path, origin, dst_dir_fd=dir_fd)
+                except Exception as e:
+                    log.error("processing %s failed due to error: %s", origin, e)
+                    continue
+                moved.append((src_path, destination))
+        finally:
+            if dir_fd is not None:
+                os.close(dir_fd)
+
+        return moved
+
+    def shutdown(self):
+        """
+        Waits for pending background moves to finish.
+        """
+        self._stopped.set()
+        self._executor.shutdown(wait=True)
 
 
 class ExtensionMapper:
-    def __init__(self, known_types={}, default="other", api_url="", name_regex=""):
+    def __init__(
+        self,
+        known_types={},
+        default="other",
+        api_url="",
+        name_regex="",
+        name_xpath="",
+        cache_path="~/.cache/folder_observer/exts.json",
+        flush_delay=5,
+    ):
         """
         Basic extension mapper, which relays on external website.
+
+        Type name is taken from the page with name_xpath when lxml is installed,
+        otherwise with name_regex.
+
+        Downloaded types are persisted to cache_path (unless it's None) and loaded
+        back on start, so known extensions are not looked up again after restart.
         """
-        self.known_types = known_types
+        self.cache_path = cache_path and os.path.expanduser(cache_path)
+        self.flush_delay = flush_delay
+        self.known_types = {
+            extension.lower(): name
+            for extension, name in (*self._load_cache().items(), *known_types.items())
+        }
+        self._spellings = {}
         self.default = default
         self.api_url = api_url
         self.name_regex = name_regex
+        self._name_re = re.compile(name_regex)
+        self.name_xpath = name_xpath
+        self._locks = {}
+        self._flush_lock = threading.Lock()
+        self._flush_timer = None
+        self._dirty = False
+        self._session = requests.Session()
+        self._session.mount(
+            "https://", HTTPAdapter(pool_connections=4, pool_maxsize=4, max_retries=1)
+        )
 
     def download_info(self, extension):
+        # concurrent events for the same new extension share a single request
+        with self._locks.setdefault(extension, threading.Lock()):
+            result = self.known_types.get(extension)
+            if result is None:
+                result = self._download_info(extension)
+        return result
+
+    def _download_info(self, extension):
         try:
-            resp = requests.get(os.path.join(self.api_url, extension))
-            content = resp.content.decode()
-            result = re.findall(self.name_regex, content)[0]
+            resp = self._session.get(
+                f"{self.api_url.rstrip('/')}/{extension}", timeout=5
+            )
+            if html is not None and self.name_xpath:
+                result = html.fromstring(resp.content).xpath(self.name_xpath)[0]
+            else:
+                result = self._name_re.search(resp.content.decode()).group(1)
         except:
             raise
             result = self.default
         result = result.replace(" ", "").replace(".", "").replace("Files", "")
         self.known_types[extension] = result
+        self._dirty = True
+        self._schedule_flush()
         return result
 
-    def get(self, origin):
-        origin = origin.lower()
-        extension = origin.split(".")[-1]
+    def _load_cache(self):
+        if not self.cache_path:
+            return {}
 
         try:
-            return self.known_types[extension]
-        except KeyError:
-            return self.download_info(extension)
+            with open(self.cache_path) as f:
+                cache = json.load(f)
+            if not isinstance(cache, dict):
+                raise ValueError(f"expected object, got {type(cache).__name__}")
+            return cache
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            log.warning("ignoring extension cache %s: %s", self.cache_path, e)
+            return {}
+
+    def _schedule_flush(self):
+        if not self.cache_path:
+            return
+
+        with self._flush_lock:
+            if self._flush_timer:
+                self._flush_timer.cancel()
+            self._flush_timer = threading.Timer(self.flush_delay, self.flush)
+            self._flush_timer.daemon = True
+            self._flush_timer.start()
+
+    def flush(self):
+        """
+        Atomically writes known types to cache file, if anything was downloaded
+        since last flush.
+        """
+        if not self.cache_path:
+            return
+
+        with self._flush_lock:
+            if self._flush_timer:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+
+            if not self._dirty:
+                return
+            self._dirty = False
+
+            try:
+                os.makedirs(os.path.dirname(self.cache_path) or ".", exist_ok=True)
+                tmp_path = f"{self.cache_path}.tmp"
+                with open(tmp_path, "w") as f:
+                    json.dump(dict(self.known_types), f)
+                os.replace(tmp_path, self.cache_path)
+            except OSError as e:
+                log.warning("writing extension cache %s failed: %s", self.cache_path, e)
+
+    def extension(self, origin):
+        return origin[origin.rfind(".") + 1 :]
+
+    def lookup(self, extension):
+        """
+        Returns already known type for extension or None, never downloads.
+
+        Known types are stored lowercase, extension is lowercased only when it's
+        not found as is and other spellings are remembered on hit (in memory only,
+        so they don't end up in cache file).
+        """
+        result = self.known_types.get(extension)
+        if result is None:
+            result = self._spellings.get(extension)
+        if result is None:
+            result = self.known_types.get(extension.lower())
+            if result is not None:
+                self._spellings[extension] = result
+        return result
+
+    def get(self, origin):
+        extension = self.extension(origin)
+        result = self.lookup(extension)
+        if result is None:
+            result = self.download_info(extension.lower())
+        return result
+
+
+def scan_files(folder, recursive=False):
+    """
+    Yields paths of regular files in folder, relying on os.scandir entry types
+    instead of stating every file.
+    """
+    with os.scandir(folder) as entries:
+        subfolders = []
+        for entry in entries:
+            if entry.is_file(follow_symlinks=False):
+                yield entry.path
+            elif recursive and entry.is_dir(follow_symlinks=False):
+                subfolders.append(entry.path)
+
+    for subfolder in subfolders:
+        yield from scan_files(subfolder, recursive)
 
 
 if __name__ == "__main__":
@@ -127,6 +543,12 @@ if __name__ == "__main__":
         "-d", "--destination", help="Destination folder", default="source"
     )
     parser.add_argument("-l", "--logfile", help="Log file")
+    parser.add_argument(
+        "-c",
+        "--cache",
+        help="Extension cache file",
+        default="~/.cache/folder_observer/exts.json",
+    )
     parser.add_argument("-v", "--debug", help="Run in debug mode", action="store_true")
     parser.add_argument(
         "-r", "--recursive", help="Recursive", action="store_true", default=False
@@ -137,6 +559,21 @@ if __name__ == "__main__":
         action="store_true",
         default=True,
     )
+    parser.add_argument(
+        "--polling",
+        help="Poll source folder instead of relying on OS notifications, "
+        "use for network shares or when notifications get lost",
+        action="store_true",
+        default=False,
+    )
+    parser.add_argument(
+        "--poll-interval",
+        help="Interval between polls in seconds, without inotify also how long "
+        "files have to stay unchanged before they are moved",
+        action="store",
+        type=float,
+        default=1,
+    )
     parser.add_argument(
         "--delay",
         help="Delay for file move action in seconds",
@@ -182,7 +619,9 @@ if __name__ == "__main__":
 
     excluded = (r".*\.crdownload$", r".*\.temp$", r".*\.part.*")
     api_url = "https://fileinfo.com/extension/"
-    name_regex = r"<a href=\"/filetypes/.+\">(.*?)</a>"
+    # both read the link in the cell next to "Category", regex is used without lxml
+    name_regex = r"<td[^>]*>Category</td>\s*<td[^>]*>\s*<a\b[^>]*>([^<]*)</a>"
+    name_xpath = '//td[text()="Category"]/following-sibling::td[1]/a/text()'
 
     known_types = {
         "pdf": "PDF",
@@ -193,35 +632,58 @@ if __name__ == "__main__":
     for ext in ("dwg", "dxf"):
         known_types[ext] = "AutoCAD"
 
-    ext_mapper = ExtensionMapper(known_types, "other", api_url, name_regex)
+    ext_mapper = ExtensionMapper(
+        known_types,
+        "other",
+        api_url,
+        name_regex,
+        name_xpath=name_xpath,
+        cache_path=args.cache,
+    )
+    inotify = not args.polling and sys.platform.startswith("linux")
     handler = NewFileHander(
         ext_mapper,
         args.destination,
         excluded,
         delay=args.delay,
         ln_duration=args.ln_duration,
+        # only inotify reports files closed after writing, anything else waits
+        # for files to stop changing
+        settle=0 if inotify else args.poll_interval,
+    )
+    if args.polling:
+        from watchdog.observers.polling import PollingObserver
+
+        # snapshot diffs report new files as created, not closed
+        observer = PollingObserver(timeout=args.poll_interval)
+        event_filter = [FileCreatedEvent, FileModifiedEvent, FileMovedEvent]
+    elif inotify:
+        from watchdog.observers.inotify import InotifyObserver
+
+        # only IN_CLOSE_WRITE and IN_MOVED_FROM/TO make it into inotify mask,
+        # full events report moves from outside as moves with empty source
+        observer = InotifyObserver(generate_full_events=True)
+        event_filter = [FileClosedEvent, FileMovedEvent]
+        if args.recursive:
+            # IN_CREATE is needed for watches on subfolders created later
+            event_filter.append(DirCreatedEvent)
+    else:
+        observer = Observer()
+        event_filter = [FileModifiedEvent, FileMovedEvent]
+
+    observer.schedule(
+        handler,
+        path=args.source,
+        recursive=args.recursive,
+        event_filter=event_filter,
     )
-    observer = Observer()
-    observer.schedule(handler, path=args.source, recursive=args.recursive)
     observer.start()
 
     if args.sort_old:
-        if args.recursive:
-            files_to_sort = [
-                os.path.join(dp, f)
-                for dp, dn, fn in os.walk(os.path.expanduser(args.source))
-                for f in fn
-            ]
-        else:
-            files_to_sort = [
-                os.path.join(args.source, f)
-                for f in os.listdir(os.path.expanduser(args.source))
-            ]
-            files_to_sort = [f for f in files_to_sort if os.path.isfile(f)]
-        event_cls = collections.namedtuple("Event", ("src_path"))
-
-        for f in files_to_sort:
-            handler.on_modified(event_cls(f))
+        files_to_sort = list(
+            scan_files(os.path.expanduser(args.source), args.recursive)
+        )
+        handler.sort(files_to_sort)
 
     try:
         while True:
@@ -229,3 +691,5 @@ if __name__ == "__main__":
     except KeyboardInterrupt:
         observer.stop()
     observer.join()
+    handler.shutdown()
+    ext_mapper.flush()
@@ -0,0 +1,32 @@
+import os
+import time
+
+from observer import ExtensionMapper, NewFileHander
+
+
+class Event:
+    def __init__(self, src_path):
+        self.src_path = src_path
+
+
+def test_ln_duration_symlink_is_not_moved(tmp_path):
+    source = tmp_path / "src"
+    source.mkdir()
+    destination = tmp_path / "dst"
+    moved = destination / "PDF" / "a.pdf"
+    moved.parent.mkdir(parents=True)
+    moved.write_text("content")
+    # temporary link left in source folder by --ln-duration
+    link = source / "a.pdf"
+    link.symlink_to(moved)
+
+    mapper = ExtensionMapper({"pdf": "PDF"}, cache_path=None)
+    handler = NewFileHander(mapper, str(destination), (), settle=0.05)
+    handler.on_created(Event(str(link)))
+    handler.on_closed(Event(str(link)))
+    time.sleep(0.3)
+    handler.shutdown()
+
+    assert link.is_symlink()
+    assert not os.path.islink(moved)
+    assert moved.read_text() == "content"